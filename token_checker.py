@@ -1,306 +1,559 @@
-# pylint: disable=broad-exception-raised,too-many-arguments
-import subprocess
-import time
-import json
-import logging
-import sys
-import random
-import os
-import re
-import traceback
-from datetime import datetime, timedelta, timezone
-import threading
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from typing import Optional
-
-from grist_api import GristDocAPI
-import colorama
-import requests
-
-
-class HealthCheckHandler(BaseHTTPRequestHandler):
-    is_healthy = True
-
-    @classmethod
-    def set_health(cls, status: bool):
-        cls.is_healthy = status
-
-    def do_GET(self):
-        if self.path == '/health':
-            if self.is_healthy:
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps({"status": "healthy"}).encode())
-            else:
-                self.send_response(503)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps({"status": "unhealthy", "reason": "Request in progress taking too long"}).encode())
-        else:
-            self.send_response(404)
-            self.end_headers()
-
-
-def run_health_server(port):
-    server = HTTPServer(('0.0.0.0', port), HealthCheckHandler)
-    server.serve_forever()
-
-
-class GristWatchdog:
-    def __init__(self, logger):
-        self._timeout = 300  # 5 minutes in seconds
-        self._lock = threading.Lock()
-        self._running = True
-        self._thread: Optional[threading.Thread] = None
-        self.logger = logger
-        self.reset_timeout()
-        self.logger.info(f"Watchdog initialized with timeout: {self._timeout} seconds")
-        self._thread = threading.Thread(target=self.decrease_timeout_thread, daemon=True)
-        self._thread.start()
-        self.logger.info("Watchdog thread started")
-        self.send_telegram_notification(f"Token checker initialized")
-
-    def send_telegram_notification(self, message):
-        try:
-            telegram_bot_token = os.getenv("TELEGRAM_BOT_TOKEN")
-            telegram_chat_id = os.getenv("TELEGRAM_CHAT_ID")
-            if telegram_bot_token and telegram_chat_id:
-                telegram_url = f"https://api.telegram.org/bot{telegram_bot_token}/sendMessage"
-                requests.post(telegram_url, json={
-                    "chat_id": telegram_chat_id,
-                    "text": message
-                }, timeout=10)
-                self.logger.info("Telegram notification sent about watchdog timeout")
-            else:
-                self.logger.warning("Telegram notification skipped - missing bot token or chat ID")
-        except Exception as e:
-            self.logger.error(f"Failed to send Telegram notification: {e}")
-
-
-    def reset_timeout(self):
-        with self._lock:
-            previous = self._timeout
-            self._timeout = 300  # Reset to 5 minutes
-            #if previous < 60:  # Логируем только если было меньше минуты
-            self.logger.info(f"Watchdog timeout reset from {previous} to {self._timeout} seconds")
-    
-    def decrease_timeout_thread(self):
-        while self._running:
-            with self._lock:
-                self._timeout = max(0, self._timeout - 10)
-                #if self._timeout < 60:  # Логируем когда осталось меньше минуты
-                self.logger.warning(f"Watchdog timeout decreased: {self._timeout} seconds")
-                if self._timeout < 60:
-                    HealthCheckHandler.set_health(False)
-                if self._timeout < 1:
-                    self.logger.error(f"Watchdog timeout reached. No activity detected for {self._timeout} seconds. Restarting application...")
-                    self.send_telegram_notification(f"Watchdog timeout reached. No activity detected for {self._timeout} seconds. Application will be restarted.")
-                    sys.exit(1)
-            time.sleep(10)
-    
-    def get_timeout(self):
-        with self._lock:
-            return self._timeout
-
-class GRIST:
-    def __init__(self, server, doc_id, api_key, nodes_table, settings_table, logger):
-        self.server = server
-        self.doc_id = doc_id
-        self.api_key = api_key
-        self.nodes_table = nodes_table.replace(" ", "_")
-        self.settings_table = settings_table.replace(" ", "_")
-        self.logger = logger
-        self.grist = GristDocAPI(doc_id, server=server, api_key=api_key)
-
-    def to_timestamp(self, dtime: datetime) -> int:
-        if dtime.tzinfo is None:
-            dtime = dtime.replace(tzinfo=timezone(timedelta(hours=3))) 
-        return int(dtime.timestamp())
-
-    def update_column(self, row_id, column_name, value, table=None):
-        if isinstance(value, datetime):
-            value = self.to_timestamp(value)
-        column_name = column_name.replace(" ", "_")
-        self.grist.update_records(table or self.nodes_table, [{ "id": row_id, column_name: value }])
-
-    def update(self, row_id, updates, table=None):
-        for column_name, value in updates.items():
-            if isinstance(value, datetime):
-                updates[column_name] = self.to_timestamp(value)
-        updates = {column_name.replace(" ", "_"): value for column_name, value in updates.items()}
-        self.grist.update_records(table or self.nodes_table, [{"id": row_id, **updates}])
-
-    def fetch_table(self, table=None):
-        return self.grist.fetch_table(table or self.nodes_table)
-
-    def find_record(self, record_id=None, state=None, name=None, table=None):
-        table = self.grist.fetch_table(table or self.nodes_table)
-        if record_id is not None:
-            record = [row for row in table if row.id == record_id]
-            return record
-        if state is not None and name is not None:
-            record = [row for row in table if row.State == state and row.name == name]
-            return record
-        if state is not None:
-            record = [row for row in table if row.State == state]
-            return record
-        if name is not None:
-            record = [row for row in table if row.Name == name]
-            return record
-
-    def find_settings(self, setting):
-        data = getattr(self.fetch_table(self.settings_table)[0], setting)
-        return data
-
-    def find_chain(self, target_id, table):
-        if target_id is None or target_id == "" or int(target_id) == 0:
-            raise Exception("Chain is None!")
-        data = self.grist.fetch_table(table)
-        if len(data) == 0:
-            raise Exception("Chains table is empty!")
-        search_result = [row for row in data if row.id == target_id]
-        if len(search_result) == 0:
-            raise Exception(f"Chain not found!")
-        chain_id = search_result[0].Chain_id
-        if chain_id is None or chain_id == "":
-            raise Exception(f"ID is None!")
-        return chain_id
-
-    def nodes_table_preprocessing(self):
-        current_time = self.to_timestamp(datetime.now())
-        max_wip = 60*60*2
-
-        self.logger.info(f"Run grist processing NoneState -> Dirty and NoneVersion -> av1")
-        for row in self.fetch_table():
-            if row.State == "": self.update_column(row.id, "State", "Dirty")
-            if row.Version == "": self.update_column(row.id, "Version", "av1")
-
-        self.logger.info(f"Run grist processing av1 and !WiP -> Dirty")
-        for row in self.fetch_table():
-            if row.Version == "av1" and row.State != "WiP" and row.State != "Dirty" and row.State != "Error": 
-                self.update_column(row.id, "State", "Dirty")
-                self.update_column(row.id, "Status", "Set Dirty by old Version")
-                
-        self.logger.info(f"Run grist processing WiP and >1d old -> Dirty")
-        for row in self.fetch_table():
-            if row.Deploy_date is not None:
-                vm_old_age = current_time - row.Deploy_date
-                if row.State == "WiP" and vm_old_age > max_wip and row.State != "Dirty":
-                    self.update_column(row.id, "State", "Dirty")
-                    self.update_column(row.id, "Status", "Set Dirty by WiP Timeout")
-
-        self.logger.info(f"Run grist processing NoneRetries -> 0/4")
-        for row in self.fetch_table():
-            if row.Retries is None or row.Retries == "":
-                self.update_column(row.id, "Retries", "0/4")
-
-
-def check_balance(address, chain_id, api_key, token, logger):
-    token_url = f"https://api.etherscan.io/v2/api?apikey={api_key}&chainid={chain_id}&module=account&action=tokenbalance&address={address}&contractaddress={token}"
-    eth_url = f"https://api.etherscan.io/v2/api?apikey={api_key}&chainid={chain_id}&module=account&action=balance&address={address}"
-    print(token_url, eth_url)
-    try:
-        if token.lower() == 'eth':
-            response = requests.get(eth_url, timeout=30)
-            data = response.json()
-            if data['status'] == '1':
-                eth_value = int(data['result']) / (10 ** 18)
-                formatted_eth_value = f"{eth_value:.18f}".rstrip('0').rstrip('.')
-                logger.info(f"Address {address} holds {formatted_eth_value} ETH")
-                return formatted_eth_value, ""
-            else:
-                if 'message' in data:
-                    if data['message'] == 'No transactions found':
-                        logger.error(f"No transactions found for address {address}")
-                        return 0, "No transactions found"
-                logger.error(f"Error while checking ETH transactions for address {address}")
-                raise Exception(f"Error while checking ETH transactions for address {address}")
-        else:
-            response = requests.get(token_url, timeout=30)
-            data = response.json()
-            if data['status'] == '1': 
-                tokens = int(data['result'])
-                logger.info(f"Address {address} holds {tokens} tokens")
-                token_value = tokens / (10 ** 18)
-                return token_value, ""
-            else:
-                if 'message' in data:
-                    if data['message'] == 'No transactions found':
-                        logger.error(f"No transactions found for address {address}")
-                        return 0, "No transactions found"
-                logger.error(f"Error while checking token transactions for address {address}")
-                raise Exception(f"Error while checking token transactions for address {address}")
-    except Exception as e:
-        #logger.error(f"Fail: {e}\n{traceback.format_exc()}")
-        logger.error(f"Error while checking token transactions for address {address}: {e}")
-        raise Exception(f"Error while checking token transactions for address {address}: {e}")
-
-
-def find_none_value(grist):
-    wallets = grist.fetch_table()
-    for wallet in wallets:
-        if (wallet.Value is None or wallet.Value == "" ):
-            if (wallet.Address is not None and wallet.Address != ""):
-                return wallet
-    return None
-    
-
-def main():
-    colorama.init(autoreset=True)
-    logger = logging.getLogger("Token checker")
-    logger.setLevel(logging.INFO)
-    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-    ch = logging.StreamHandler()
-    ch.setFormatter(formatter)
-    logger.addHandler(ch)
-
-    grist_server = os.getenv("GRIST_SERVER")
-    grist_doc_id = os.getenv("GRIST_DOC_ID")
-    grist_api_key = os.getenv("GRIST_API_KEY")
-    etherscan_api_key = os.getenv("ETHERSCAN_API_KEY")
-    if grist_server is None or grist_doc_id is None or grist_api_key is None or etherscan_api_key is None:
-        logger.error("Please set GRIST_SERVER, GRIST_DOC_ID, GRIST_API_KEY, ETHERSCAN_API_KEY env variables")
-        sys.exit(1)
-    nodes_table = "Wallets"
-    settings_table = "Settings"
-    chains_table = "Chains" 
-    watchdog = GristWatchdog(logger)
-    grist = GRIST(grist_server, grist_doc_id, grist_api_key, nodes_table, settings_table, logger)
-
-    health_port = int(os.getenv('HEALTH_PORT', '8080'))
-    health_thread = threading.Thread(target=run_health_server, args=(health_port,), daemon=True)
-    health_thread.start()
-    logger.info(f"Health check server started on port {health_port}")
-
-    while True:
-        try:
-            watchdog.reset_timeout()
-            chain = grist.find_settings("Chain")
-            chain_id = grist.find_chain(chain, chains_table)
-            logger.info(f"Chain: {chain}/{chain_id}")
-            token = grist.find_settings("Token")
-            try:
-                none_value_wallet = find_none_value(grist)
-                if none_value_wallet is None:
-                    logger.info("All wallets have values, sleep 10s")
-                    time.sleep(10)
-                    continue
-                
-                logger.info(f"Check wallet {none_value_wallet.Address}/{chain_id}...")
-                HealthCheckHandler.set_health(False)
-                value, msg = check_balance(none_value_wallet.Address, chain_id, etherscan_api_key, token, logger)
-                HealthCheckHandler.set_health(True)
-                grist.update(none_value_wallet.id, {"Value": value, "Comment": msg})  
-            except Exception as e:
-                HealthCheckHandler.set_health(True)
-                grist.update(none_value_wallet.id, {"Value": "--", "Comment": f"Error: {e}"})  
-                logger.error(f"Error occurred: {e}")
-        except Exception as e:
-            HealthCheckHandler.set_health(True)
-            logger.error(f"Error occurred, sleep 10s: {e}")
-            time.sleep(10)
-
-
-if __name__ == "__main__":
-    main()
+# pylint: disable=broad-exception-raised,too-many-arguments
+import time
+import json
+import logging
+import sys
+import random
+import os
+import queue
+from datetime import datetime, timedelta, timezone
+from decimal import Context, Decimal
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from types import SimpleNamespace
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=4, pool_maxsize=16,
+    max_retries=Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504],
+                      respect_retry_after_header=True)))
+
+TELEGRAM_SESSION = requests.Session()
+TELEGRAM_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=1, pool_maxsize=2,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                      allowed_methods=["GET", "POST"])))
+
+
+class RateLimiter:
+    def __init__(self, rate=5, capacity=5):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            if self.tokens < 1:
+                wait = (1 - self.tokens) / self.rate
+                time.sleep(wait)
+                # the slept interval is consumed by this acquire, don't re-credit it
+                self.last_refill = time.monotonic()
+                self.tokens = 0
+            else:
+                self.tokens -= 1
+
+
+ETHERSCAN_LIMITER = RateLimiter(rate=5, capacity=5)
+
+WEI = Decimal(10) ** 18
+# default context is 28 significant digits, not enough for large wei balances;
+# an explicit context also sidesteps the thread-local default in the worker pool
+DECIMAL_CONTEXT = Context(prec=40)
+
+logger = logging.getLogger("Token checker")
+_COLORAMA_INITIALIZED = False
+
+WAKE_QUEUE = queue.Queue()  # filled by the Grist webhook endpoint to wake the idle main loop
+
+
+def retry_with_backoff(func, logger, attempts=5, base=1, cap=32):
+    for attempt in range(attempts):
+        try:
+            return func()
+        except Exception as e:
+            if attempt == attempts - 1:
+                raise
+            delay = min(cap, base * 2 ** attempt) * (1 + random.random() * 0.5)
+            logger.warning("Attempt %d/%d failed, retry in %.1fs: %s", attempt + 1, attempts, delay, e)
+            time.sleep(delay)
+
+
+class HealthCheckHandler(BaseHTTPRequestHandler):
+    is_healthy = True
+    _HEALTHY = b'{"status": "healthy"}'
+    _UNHEALTHY = b'{"status": "unhealthy", "reason": "Request in progress taking too long"}'
+
+    @classmethod
+    def set_health(cls, status: bool):
+        cls.is_healthy = status
+
+    def do_GET(self):
+        if self.path == '/health':
+            healthy = self.is_healthy  # single read so body and status can't disagree mid-toggle
+            body = self._HEALTHY if healthy else self._UNHEALTHY
+            self.send_response(200 if healthy else 503)
+            self.send_header('Content-type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_response(404)
+            self.end_headers()
+
+    def do_POST(self):
+        if self.path == '/grist-webhook':
+            length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(length)
+            try:
+                events = json.loads(body) if body else []
+            except Exception:
+                events = []
+            WAKE_QUEUE.put(events)
+            self.send_response(200)
+            self.end_headers()
+        else:
+            self.send_response(404)
+            self.end_headers()
+
+
+class HealthServer(ThreadingHTTPServer):
+    request_queue_size = 128  # must be a class attribute: __init__ calls listen() with it
+
+
+def run_health_server(port):
+    server = HealthServer(('0.0.0.0', port), HealthCheckHandler)
+    server.serve_forever()
+
+
+class GristWatchdog:
+    def __init__(self, logger):
+        self._timeout = 300  # 5 minutes in seconds
+        self._deadline = time.monotonic() + self._timeout
+        self._event = threading.Event()
+        self._running = True
+        self._thread: Optional[threading.Thread] = None
+        self.logger = logger
+        self.logger.info("Watchdog initialized with timeout: %d seconds", self._timeout)
+        self._thread = threading.Thread(target=self.watchdog_thread, daemon=True)
+        self._thread.start()
+        self.logger.info("Watchdog thread started")
+        self.send_telegram_notification(f"Token checker initialized")
+
+    def send_telegram_notification(self, message):
+        try:
+            telegram_bot_token = os.getenv("TELEGRAM_BOT_TOKEN")
+            telegram_chat_id = os.getenv("TELEGRAM_CHAT_ID")
+            if telegram_bot_token and telegram_chat_id:
+                telegram_url = f"https://api.telegram.org/bot{telegram_bot_token}/sendMessage"
+                TELEGRAM_SESSION.post(telegram_url, json={
+                    "chat_id": telegram_chat_id,
+                    "text": message
+                }, timeout=(3.05, 7))
+                self.logger.info("Telegram notification sent about watchdog timeout")
+            else:
+                self.logger.warning("Telegram notification skipped - missing bot token or chat ID")
+        except Exception as e:
+            self.logger.error("Failed to send Telegram notification: %s", e)
+
+
+    def reset_timeout(self):
+        # attribute assignment of a float is atomic under the GIL, no lock needed
+        self._deadline = time.monotonic() + self._timeout
+        self._event.set()
+
+    def watchdog_thread(self):
+        healthy = True
+        while self._running:
+            try:
+                self._event.wait(timeout=10)
+                self._event.clear()
+                remaining = self._deadline - time.monotonic()
+                if remaining < 60:
+                    HealthCheckHandler.set_health(False)
+                    if healthy:
+                        self.logger.warning("Watchdog timeout low: %.0f seconds remaining", remaining)
+                        healthy = False
+                elif not healthy:
+                    HealthCheckHandler.set_health(True)
+                    self.logger.info("Watchdog timeout recovered: %.0f seconds remaining", remaining)
+                    healthy = True
+                if remaining <= 0:
+                    self.logger.error("Watchdog timeout reached. No activity detected for %d seconds. Restarting application...", self._timeout)
+                    self.send_telegram_notification(f"Watchdog timeout reached. No activity detected for {self._timeout} seconds. Application will be restarted.")
+                    # sys.exit only kills this daemon thread; _exit takes the whole process down
+                    os._exit(1)
+            except Exception:
+                try:
+                    self.logger.exception("Watchdog tick failed")
+                except Exception:
+                    pass
+                time.sleep(10)
+
+    def get_timeout(self):
+        return max(0, self._deadline - time.monotonic())
+
+class GristClient:
+    def __init__(self, server, doc_id, api_key):
+        self.base_url = f"{server.rstrip('/')}/api/docs/{doc_id}"
+        self.session = SESSION
+        self.headers = {"Authorization": f"Bearer {api_key}", "Accept": "application/json"}
+        self._etags = {}   # cache key -> ETag of the last 200 response
+        self._rows = {}    # cache key -> parsed rows for 304 revalidation
+
+    def fetch_table(self, table_name, filters=None):
+        params = {}
+        cache_key = table_name
+        if filters:
+            params["filter"] = json.dumps({k: [v] for k, v in filters.items()}, sort_keys=True)
+            cache_key = (table_name, params["filter"])
+        headers = dict(self.headers)
+        etag = self._etags.get(cache_key)
+        if etag is not None:
+            headers["If-None-Match"] = etag
+        response = self.session.get(f"{self.base_url}/tables/{table_name}/records", params=params, headers=headers, timeout=(5, 15))
+        if response.status_code == 304:
+            return self._rows[cache_key]
+        response.raise_for_status()
+        records = json.loads(response.content)["records"]
+        rows = [SimpleNamespace(id=record["id"], **record["fields"]) for record in records]
+        if "ETag" in response.headers:
+            self._etags[cache_key] = response.headers["ETag"]
+            self._rows[cache_key] = rows
+        return rows
+
+    def update_records(self, table_name, records):
+        payload = {"records": [{"id": record["id"], "fields": {k: v for k, v in record.items() if k != "id"}} for record in records]}
+        response = self.session.patch(f"{self.base_url}/tables/{table_name}/records",
+                                      headers={**self.headers, "Content-Type": "application/json"},
+                                      data=json.dumps(payload), timeout=(5, 15))
+        response.raise_for_status()
+
+
+class TableView:
+    def __init__(self, rows):
+        self.rows = rows
+        self._by_id = None
+        self._by_state = None
+        self._by_name = None
+
+    @property
+    def by_id(self):
+        if self._by_id is None:
+            self._by_id = {row.id: row for row in self.rows}
+        return self._by_id
+
+    @property
+    def by_state(self):
+        if self._by_state is None:
+            index = {}
+            for row in self.rows:
+                index.setdefault(row.State, []).append(row)
+            self._by_state = index
+        return self._by_state
+
+    @property
+    def by_name(self):
+        if self._by_name is None:
+            index = {}
+            for row in self.rows:
+                index.setdefault(row.Name, []).append(row)
+            self._by_name = index
+        return self._by_name
+
+
+class GRIST:
+    _DEFAULT_TZ = timezone(timedelta(hours=3))
+
+    def __init__(self, server, doc_id, api_key, nodes_table, settings_table, logger):
+        self.server = server
+        self.doc_id = doc_id
+        self.api_key = api_key
+        self.nodes_table = nodes_table.replace(" ", "_")
+        self.settings_table = settings_table.replace(" ", "_")
+        self.logger = logger
+        self.grist = GristClient(server, doc_id, api_key)
+        self._cache = {}  # (table, key) -> (value, expires_at)
+        self._cache_ttl = 60
+        self._pending = {}  # table -> list of row patches
+        self._batch_size = 50
+        # column name -> sanitized column name, pre-seeded with the columns this checker writes
+        self._col_cache = {name: name for name in ("State", "Status", "Version", "Value", "Comment", "Retries", "Deploy_date")}
+
+    def _cache_get(self, key):
+        cached = self._cache.get(key)
+        if cached is not None and cached[1] > time.time():
+            return cached[0]
+        return None
+
+    def _cache_put(self, key, value, ttl=None):
+        self._cache[key] = (value, time.time() + (ttl or self._cache_ttl))
+        return value
+
+    def refresh(self):
+        self._cache.clear()
+
+    def to_timestamp(self, dtime: datetime) -> int:
+        return int((dtime if dtime.tzinfo else dtime.replace(tzinfo=self._DEFAULT_TZ)).timestamp())
+
+    def _norm_col(self, column_name):
+        cached = self._col_cache.get(column_name)
+        if cached is None:
+            cached = self._col_cache.setdefault(column_name, column_name.replace(" ", "_"))
+        return cached
+
+    def _build_payload(self, updates):
+        return {self._norm_col(column_name): (self.to_timestamp(value) if isinstance(value, datetime) else value)
+                for column_name, value in updates.items()}
+
+    def update_column(self, row_id, column_name, value, table=None):
+        if isinstance(value, datetime):
+            value = self.to_timestamp(value)
+        self.grist.update_records(table or self.nodes_table, [{ "id": row_id, self._norm_col(column_name): value }])
+
+    def update(self, row_id, updates, table=None):
+        self.grist.update_records(table or self.nodes_table, [{"id": row_id, **self._build_payload(updates)}])
+
+    def update_many(self, updates, table=None):
+        rows = [{"id": row["id"], **self._build_payload({column_name: value for column_name, value in row.items() if column_name != "id"})} for row in updates]
+        self.grist.update_records(table or self.nodes_table, rows)
+
+    def queue_update(self, row_id, updates, table=None):
+        self._pending.setdefault(table or self.nodes_table, []).append({"id": row_id, **self._build_payload(updates)})
+
+    def flush(self):
+        for table, patches in self._pending.items():
+            for i in range(0, len(patches), self._batch_size):
+                self.grist.update_records(table, patches[i:i + self._batch_size])
+        self._pending.clear()
+
+    def fetch_table(self, table=None, filters=None):
+        return self.grist.fetch_table(table or self.nodes_table, filters=filters)
+
+    def fetch_view(self, table=None, ttl=10):
+        table = table or self.nodes_table
+        view = self._cache_get((table, "__view__"))
+        if view is None:
+            view = self._cache_put((table, "__view__"), TableView(self.grist.fetch_table(table)), ttl=ttl)
+        return view
+
+    def find_record(self, record_id=None, state=None, name=None, table=None):
+        view = self.fetch_view(table)
+        if record_id is not None:
+            row = view.by_id.get(record_id)
+            return [] if row is None else [row]
+        if state is not None and name is not None:
+            record = [row for row in view.by_state.get(state, []) if row.name == name]
+            return record
+        if state is not None:
+            record = list(view.by_state.get(state, []))
+            return record
+        if name is not None:
+            record = list(view.by_name.get(name, []))
+            return record
+
+    def find_settings(self, setting):
+        cached = self._cache_get((self.settings_table, setting))
+        if cached is not None:
+            return cached
+        data = getattr(self.fetch_table(self.settings_table)[0], setting)
+        return self._cache_put((self.settings_table, setting), data)
+
+    def find_chain(self, target_id, table):
+        if not target_id or int(target_id) == 0:
+            raise Exception("Chain is None!")
+        cached = self._cache_get((table, target_id))
+        if cached is not None:
+            return cached
+        # Chains change rarely, so keep the view for the full cache TTL
+        view = self.fetch_view(table, ttl=self._cache_ttl)
+        if len(view.rows) == 0:
+            raise Exception("Chains table is empty!")
+        chain = view.by_id.get(target_id)
+        if chain is None:
+            raise Exception(f"Chain not found!")
+        chain_id = chain.Chain_id
+        if chain_id is None or chain_id == "":
+            raise Exception(f"ID is None!")
+        return self._cache_put((table, target_id), chain_id)
+
+    def nodes_table_preprocessing(self):
+        current_time = self.to_timestamp(datetime.now())
+        max_wip = 60*60*2
+
+        self.logger.info("Run grist processing: NoneState -> Dirty, NoneVersion -> av1, av1 and !WiP -> Dirty, WiP timeout -> Dirty, NoneRetries -> 0/4")
+        for row in self.fetch_view().rows:
+            patch = {}
+            state = row.State
+            version = row.Version
+            if state == "":
+                state = "Dirty"
+                patch["State"] = "Dirty"
+            if version == "":
+                version = "av1"
+                patch["Version"] = "av1"
+            if version == "av1" and state != "WiP" and state != "Dirty" and state != "Error":
+                state = "Dirty"
+                patch["State"] = "Dirty"
+                patch["Status"] = "Set Dirty by old Version"
+            if row.Deploy_date is not None:
+                vm_old_age = current_time - row.Deploy_date
+                if state == "WiP" and vm_old_age > max_wip:
+                    state = "Dirty"
+                    patch["State"] = "Dirty"
+                    patch["Status"] = "Set Dirty by WiP Timeout"
+            if row.Retries is None or row.Retries == "":
+                patch["Retries"] = "0/4"
+            if patch:
+                self.queue_update(row.id, patch)
+        self.flush()
+
+
+ETHERSCAN_API_URL = "https://api.etherscan.io/v2/api"
+
+
+def _call_etherscan(params, address, logger, kind, divisor=WEI):
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Etherscan request: %s", {k: v for k, v in params.items() if k != "apikey"})
+    ETHERSCAN_LIMITER.acquire()
+    response = SESSION.get(ETHERSCAN_API_URL, params=params, timeout=(5, 15))
+    response.raise_for_status()
+    data = json.loads(response.content)
+    if data['status'] == '1':
+        return DECIMAL_CONTEXT.divide(Decimal(data['result']), divisor), ""
+    if data.get('message') == 'No transactions found':
+        logger.error("No transactions found for address %s", address)
+        return Decimal(0), "No transactions found"
+    logger.error("Error while checking %s transactions for address %s", kind, address)
+    raise Exception(f"Error while checking {kind} transactions for address {address}")
+
+
+def _check_eth_balance(address, chain_id, api_key, logger):
+    params = {"apikey": api_key, "chainid": chain_id, "module": "account", "action": "balance", "address": address}
+    def _check():
+        value, msg = _call_etherscan(params, address, logger, "ETH")
+        if msg:
+            return 0, msg
+        formatted_eth_value = format(value.normalize(DECIMAL_CONTEXT), 'f')
+        logger.info("Address %s holds %s ETH", address, formatted_eth_value)
+        return formatted_eth_value, ""
+    return retry_with_backoff(_check, logger)
+
+
+def _check_token_balance(address, chain_id, api_key, logger, contract):
+    params = {"apikey": api_key, "chainid": chain_id, "module": "account", "action": "tokenbalance",
+              "address": address, "contractaddress": contract}
+    def _check():
+        value, msg = _call_etherscan(params, address, logger, "token")
+        if msg:
+            return 0, msg
+        logger.info("Address %s holds %s tokens", address, format(value.normalize(DECIMAL_CONTEXT), 'f'))
+        return float(value), ""
+    return retry_with_backoff(_check, logger)
+
+
+def find_pending_wallets(grist):
+    # Grist filters match a single value per column, so query None and "" separately
+    pending = []
+    seen = set()
+    for empty_value in (None, ""):
+        for wallet in grist.fetch_table(filters={"Value": empty_value}):
+            address = wallet.Address
+            wallet_id = wallet.id
+            if address is not None and address != "" and wallet_id not in seen:
+                seen.add(wallet_id)
+                pending.append(wallet)
+    return pending
+
+
+def main():
+    global _COLORAMA_INITIALIZED
+    if not _COLORAMA_INITIALIZED and sys.stderr.isatty():
+        import colorama
+        colorama.init(autoreset=True)
+        _COLORAMA_INITIALIZED = True
+    if not logger.handlers:
+        logger.setLevel(logging.INFO)
+        formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+        ch = logging.StreamHandler()
+        ch.setFormatter(formatter)
+        logger.addHandler(ch)
+
+    required = {name: os.getenv(name) for name in ("GRIST_SERVER", "GRIST_DOC_ID", "GRIST_API_KEY", "ETHERSCAN_API_KEY")}
+    missing = [name for name, value in required.items() if not value]
+    if missing:
+        logger.error("Missing env variables: %s", ", ".join(missing))
+        sys.exit(1)
+    grist_server = required["GRIST_SERVER"]
+    grist_doc_id = required["GRIST_DOC_ID"]
+    grist_api_key = required["GRIST_API_KEY"]
+    etherscan_api_key = required["ETHERSCAN_API_KEY"]
+    nodes_table = "Wallets"
+    settings_table = "Settings"
+    chains_table = "Chains" 
+    watchdog = GristWatchdog(logger)
+    grist = GRIST(grist_server, grist_doc_id, grist_api_key, nodes_table, settings_table, logger)
+
+    health_port = int(os.getenv('HEALTH_PORT', '8080'))
+    health_thread = threading.Thread(target=run_health_server, args=(health_port,), daemon=True)
+    health_thread.start()
+    logger.info("Health check server started on port %d", health_port)
+
+    idle_sleep = 1.0
+    max_idle_sleep = 120  # must stay well below the watchdog budget (300s), which is only reset at the top of the loop
+    while True:
+        try:
+            watchdog.reset_timeout()
+            chain = grist.find_settings("Chain")
+            chain_id = grist.find_chain(chain, chains_table)
+            logger.info("Chain: %s/%s", chain, chain_id)
+            token = grist.find_settings("Token")
+            if token.lower() == 'eth':
+                checker = _check_eth_balance
+            else:
+                checker = partial(_check_token_balance, contract=token)
+            pending_wallets = find_pending_wallets(grist)
+            if not pending_wallets:
+                idle_sleep = min(max_idle_sleep, idle_sleep * 2)
+                logger.info("All wallets have values, wait up to %.0fs for a webhook", idle_sleep)
+                try:
+                    WAKE_QUEUE.get(timeout=idle_sleep)
+                    while not WAKE_QUEUE.empty():
+                        WAKE_QUEUE.get_nowait()
+                    grist.refresh()
+                    idle_sleep = 1.0
+                    logger.info("Woken by Grist webhook")
+                except queue.Empty:
+                    pass
+                continue
+            idle_sleep = 1.0
+
+            logger.info("Check %d wallets on chain %s...", len(pending_wallets), chain_id)
+            HealthCheckHandler.set_health(False)
+            try:
+                with ThreadPoolExecutor(max_workers=5) as executor:
+                    futures = {executor.submit(checker, wallet.Address, chain_id, etherscan_api_key, logger): wallet for wallet in pending_wallets}
+                    for future in as_completed(futures):
+                        watchdog.reset_timeout()
+                        wallet = futures[future]
+                        try:
+                            value, msg = future.result()
+                            grist.queue_update(wallet.id, {"Value": value, "Comment": msg})
+                        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+                            # transient network failure: leave Value empty so the next sweep retries
+                            logger.warning("Network error for wallet %s, will retry next sweep: %s", wallet.Address, e)
+                        except Exception as e:
+                            grist.queue_update(wallet.id, {"Value": "--", "Comment": f"Error: {e}"})
+                            logger.error("Error occurred: %s", e)
+            finally:
+                HealthCheckHandler.set_health(True)
+                grist.flush()
+        except Exception as e:
+            HealthCheckHandler.set_health(True)
+            logger.error("Error occurred, sleep 10s: %s", e)
+            time.sleep(10)
+
+
+if __name__ == "__main__":
+    main()